@@ -1,12 +1,59 @@
-import requests, math, json
+import requests, math, asyncio, hashlib, sqlite3, random, shutil, io
 
+import aiohttp
+import orjson
+import numpy as np
 import geopandas as gpd
 import matplotlib.pyplot as plt
 
-from tqdm import tqdm
-from time import sleep
-from geopy.distance import geodesic
-from os import remove, path, makedirs
+from tqdm.asyncio import tqdm as tqdm_asyncio
+from os import remove, replace, path, makedirs
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from time import monotonic
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+WORLDPOP_STATS_URL = 'https://api.worldpop.org/v1/services/stats'
+WORLDPOP_TASKS_URL = 'https://api.worldpop.org/v1/tasks/'
+
+# Polling of asynchronous WorldPop tasks, timeouts in s
+POLL_BASE_TIMEOUT, POLL_MAX_TIMEOUT, POLL_MAX_ATTEMPT = 2, 60, 8
+POLL_DEADLINE = 600
+
+EARTH_RADIUS = 6371000
+
+# Number of fetched populations inserted into the cache between commits
+CACHE_COMMIT_SIZE = 100
+
+# Number of grid divisions serialised per shard, and the number of divisions above which shards
+# are built in parallel, below this starting worker processes costs more than it saves
+GRID_SHARD_SIZE = 10000
+GRID_PARALLEL_SIZE = 1000000
+
+# Shared session for synchronous requests, so connections are kept alive between
+# requests and failed requests are retried
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[502, 503, 504]))
+_SESSION.mount('https://', _ADAPTER)
+_SESSION.mount('http://', _ADAPTER)
+
+def get_bounds_limits(bounds):
+    """
+    Gets the minimum & maximum x and y values of bounds.
+    :param bounds: Coordinates of 2 diagonally opposite corners, or all 4 corners of bounds
+    :return: Tuple of (min_x, max_x, min_y, max_y)
+    """
+
+    if len(bounds) == 2:
+        (x1, y1), (x2, y2) = bounds
+        min_x, max_x = (x1, x2) if x1 < x2 else (x2, x1)
+        min_y, max_y = (y1, y2) if y1 < y2 else (y2, y1)
+    else:
+        xs, ys = zip(*bounds)
+        min_x, max_x, min_y, max_y = min(xs), max(xs), min(ys), max(ys)
+
+    return min_x, max_x, min_y, max_y
 
 def create_summary_file(output_file, bounds, divisions, print_output=True):
     """
@@ -25,24 +72,96 @@ def create_summary_file(output_file, bounds, divisions, print_output=True):
         dataset_name = filepath.split('/')[-1]
         title, filepath = '# Summary: ' + dataset_name, dataset_name + '_summary.md'
 
-    with open(subdirectory+'/'+filepath, 'w') as summary_file:
-        summary_file.write(title)
+    summary = io.StringIO()
+    summary.write(title)
+
+    min_x, max_x, min_y, max_y = get_bounds_limits(bounds)
+    summary.write("\n\n## Bounds:\n - Latitude: {0} -> {1}\n - Longitude: {2} -> {3}".format(min_x, max_x, min_y, max_y))
     
-        max_x, min_x = max([coor[0] for coor in bounds]), min([coor[0] for coor in bounds])
-        max_y, min_y = max([coor[1] for coor in bounds]), min([coor[1] for coor in bounds])
-        summary_file.write("\n\n## Bounds:\n - Latitude: {0} -> {1}\n - Longitude: {2} -> {3}".format(min_x, max_x, min_y, max_y))
-        
-        y_divisions, x_divisions = divisions[0][0], divisions[1][0]
-        summary_file.write("\n - Height: {0}m\n - Width: {1}m".format(round(divisions[0][-1] * y_divisions, 2), round(divisions[1][-1] * x_divisions, 2)))
-
-        summary_file.write("\n\n## Divisions:\n - {0} regions ({1}x{2})".format(x_divisions * y_divisions, x_divisions, y_divisions))  
-        summary_file.write("\n - Height: {0}m\n - Width: {1}m".format(round(divisions[0][-1], 2), round(divisions[1][-1], 2)))
+    y_divisions, x_divisions = divisions[0][0], divisions[1][0]
+    summary.write("\n - Height: {0}m\n - Width: {1}m".format(round(divisions[0][-1] * y_divisions, 2), round(divisions[1][-1] * x_divisions, 2)))
+
+    summary.write("\n\n## Divisions:\n - {0} regions ({1}x{2})".format(x_divisions * y_divisions, x_divisions, y_divisions))  
+    summary.write("\n - Height: {0}m\n - Width: {1}m".format(round(divisions[0][-1], 2), round(divisions[1][-1], 2)))
+
+    # The summary is written & printed from the same buffer, rather than read back from the file
+    summary = summary.getvalue()
+    with open(subdirectory+'/'+filepath, 'w') as summary_file:
+        summary_file.write(summary)
     
     if print_output:
-        with open(subdirectory+'/'+filepath, 'r') as file:
-            for line in file: print(line.replace('\n', ''))
+        print(summary)
         print()
 
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """
+    Calculates the great-circle distance between two coordinates, works element-wise on numpy arrays.
+    :param lat1: Latitude of first coordinate
+    :param lon1: Longitude of first coordinate
+    :param lat2: Latitude of second coordinate
+    :param lon2: Longitude of second coordinate
+    :return: Distance in m
+    """
+
+    lat1, lat2 = np.radians(lat1), np.radians(lat2)
+    lat_diff, lon_diff = lat2 - lat1, np.radians(lon2 - lon1)
+
+    a = np.sin(lat_diff / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(lon_diff / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+def _build_grid_corners(min_x, min_y, division_width, division_height, x_start, x_end, num_y):
+    """
+    Generates the corners of a range of grid divisions, ordered by x then y.
+    :param min_x: Minimum x value of bounds
+    :param min_y: Minimum y value of bounds
+    :param division_width: Width of a division in degrees
+    :param division_height: Height of a division in degrees
+    :param x_start: Index of the first x division
+    :param x_end: Index after the last x division
+    :param num_y: Number of y divisions
+    :return: ((x_end - x_start) * num_y, 4, 2) array of [y, x] corners
+    """
+
+    xs = min_x + np.arange(x_start, x_end) * division_width
+    ys = min_y + np.arange(num_y) * division_height
+    grid_x, grid_y = [coors.ravel() for coors in np.meshgrid(xs, ys, indexing='ij')]
+
+    return np.stack([np.stack([grid_y, grid_x], axis=-1),
+                     np.stack([grid_y, grid_x + division_width], axis=-1),
+                     np.stack([grid_y + division_height, grid_x + division_width], axis=-1),
+                     np.stack([grid_y + division_height, grid_x], axis=-1)], axis=1)
+
+def _serialize_grid_shard(x_start, min_x, min_y, division_width, division_height, num_x, num_y, shard_rows):
+    """
+    Serialises the grid divisions of a range of x divisions as GEOJSON features.
+    :param x_start: Index of the first x division in the shard
+    :param min_x: Minimum x value of bounds
+    :param min_y: Minimum y value of bounds
+    :param division_width: Width of a division in degrees
+    :param division_height: Height of a division in degrees
+    :param num_x: Total number of x divisions
+    :param num_y: Total number of y divisions
+    :param shard_rows: Number of x divisions in each shard
+    :return: Comma separated JSON encoded features
+    """
+
+    x_end = min(x_start + shard_rows, num_x)
+    corners = _build_grid_corners(min_x, min_y, division_width, division_height, x_start, x_end, num_y)
+
+    features = [{"type":"Feature","properties":{},"geometry":{"type":"Polygon","coordinates": [coors]}} for coors in corners.tolist()]
+    return orjson.dumps(features)[1:-1]
+
+def _write_grid_shards(output, shards):
+    """
+    Writes serialised grid shards to a file as a comma separated list of features.
+    :param output: File object opened in binary mode
+    :param shards: Iterable of serialised shards, in order
+    """
+
+    for i, shard in enumerate(shards):
+        if i > 0: output.write(b',')
+        output.write(shard)
+
 def generate_geojson_grid(bounds, min_division=100, num_divisions=None, output_file='grid.geojson'):
     """
     Generates a grid with defined bounds in a GEOJSON format.
@@ -53,24 +172,24 @@ def generate_geojson_grid(bounds, min_division=100, num_divisions=None, output_f
     """
 
     if len(bounds) in [2, 4]:
-        max_x, min_x = max([coor[0] for coor in bounds]), min([coor[0] for coor in bounds])
-        max_y, min_y = max([coor[1] for coor in bounds]), min([coor[1] for coor in bounds])
+        min_x, max_x, min_y, max_y = get_bounds_limits(bounds)
     else:
         print('Invalid bounds')
         exit()
 
-    height = geodesic([min_x, min_y], [min_x, max_y]).km * 1000
-    width = geodesic([min_x, min_y], [max_x, min_y]).km * 1000
+    height = haversine_distance(min_x, min_y, min_x, max_y)
+    width = haversine_distance(min_x, min_y, max_x, min_y)
 
     divisions = []
     if num_divisions == None:
         # Calculate number & dimensions of smallest possible divisions
         for dimension, diff in zip([width, height], [max_x - min_x, max_y - min_y]):
             division_size = min_division
-            num_divisions = dimension / division_size
-            if not num_divisions.is_integer():
-                division_size = min_division + (((num_divisions % 1) * min_division)/math.floor(num_divisions))
-            divisions.append([math.floor(num_divisions), diff / math.floor(num_divisions), division_size])
+            exact_divisions = dimension / division_size
+            dim_division = math.floor(exact_divisions)
+            if not exact_divisions.is_integer():
+                division_size = min_division + (((exact_divisions % 1) * min_division)/dim_division)
+            divisions.append([dim_division, diff / dim_division, division_size])
     else:
         num_divisions.reverse()
         for dim_division, dimension, diff in zip(num_divisions, [width, height], [max_x - min_x, max_y - min_y]):
@@ -78,28 +197,27 @@ def generate_geojson_grid(bounds, min_division=100, num_divisions=None, output_f
 
     create_summary_file(output_file, bounds, divisions)
 
-    # Save each grid division in GEOJSON format
-    geojson_grid = {"type":"FeatureCollection","features":[]}
-    current_grid_coors = [min_x, min_y]
-    for _ in range(divisions[0][0]):
-        for _ in range(divisions[1][0]):
-            curr_x, curr_y = current_grid_coors
-            division_width, division_height = divisions[0][1], divisions[1][1]
-            coors = [[curr_y, curr_x],
-                     [curr_y, curr_x + division_width],
-                     [curr_y + division_height, curr_x + division_width],
-                     [curr_y + division_height, curr_x]]
-
-            polygon = {"type":"Feature","properties":{},"geometry":{"type":"Polygon","coordinates": [coors]}}
-            geojson_grid['features'].append(polygon)
-            current_grid_coors[1] += division_height
-        
-        current_grid_coors[1] = min_y
-        current_grid_coors[0] += division_width
+    # Serialise the grid in shards of x divisions, which are built in parallel for large grids
+    num_x, num_y = divisions[0][0], divisions[1][0]
+    shard_rows = max(1, GRID_SHARD_SIZE // num_y)
+    serialize_shard = partial(_serialize_grid_shard, min_x=min_x, min_y=min_y, division_width=divisions[0][1],
+                              division_height=divisions[1][1], num_x=num_x, num_y=num_y, shard_rows=shard_rows)
 
+    # Save each grid division in GEOJSON format, written one shard at a time
+    # so the full FeatureCollection is never held in memory
     if not output_file.endswith('.geojson'): output_file += '.geojson'
-    with open(output_file, 'w') as output:
-        json.dump(geojson_grid, output, indent=4)
+    with open(output_file, 'wb') as output:
+        output.write(b'{"type":"FeatureCollection","features":[')
+
+        x_starts = range(0, num_x, shard_rows)
+        num_workers = min(len(x_starts), cpu_count())
+        if num_x * num_y >= GRID_PARALLEL_SIZE and num_workers > 1:
+            with Pool(num_workers) as pool:
+                shards = pool.imap(serialize_shard, x_starts)
+                _write_grid_shards(output, shards)
+        else: _write_grid_shards(output, map(serialize_shard, x_starts))
+
+        output.write(b']}')
 
 def visualise_gpd_data(geojson_file, data_key='population'):
     """
@@ -114,82 +232,345 @@ def visualise_gpd_data(geojson_file, data_key='population'):
     gpd_data.plot(column=data_key, ax=ax, legend=True)
     plt.show(block=True)
 
-def get_worldpop_data(geojson_file, year=2010, output_file='pop.geojson', delete_original=True):
+class WorldPopError(Exception):
+    """
+    Raised when the WorldPop API returns an error for a request or task.
+    """
+
+# Errors that fail a single request, leaving its features to be fetched on a later run
+FETCH_ERRORS = (WorldPopError, aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError)
+
+async def _read_worldpop_response(response):
+    """
+    Reads the JSON body of a WorldPop API response.
+    :param response: aiohttp response
+    :return: Response object, with at least 'status' and 'error' keys
+    """
+
+    # Error pages (eg. a 502 from a proxy) are not JSON, so are raised as an error of the request
+    try: response_json = await response.json(content_type=None)
+    except ValueError: raise WorldPopError('Invalid response from API (HTTP {0})'.format(response.status))
+
+    if not isinstance(response_json, dict) or 'status' not in response_json or 'error' not in response_json:
+        raise WorldPopError('Unexpected response from API (HTTP {0})'.format(response.status))
+    return response_json
+
+async def _request_worldpop_stats(session, semaphore, encoded_features, year):
+    """
+    Requests WorldPop population statistics for a collection of features.
+    :param session: aiohttp ClientSession shared between requests
+    :param semaphore: Semaphore bounding the number of concurrent requests
+    :param encoded_features: JSON encoded GEOJSON features to send as a single FeatureCollection
+    :param year: Year for population statistics (2000-2020)
+    :return: 'data' object of the API response
+    """
+
+    payload = b'{"type":"FeatureCollection","features":[' + b','.join(encoded_features) + b']}'
+
+    # The GEOJSON is sent as form data, as batches quickly exceed URL length limits. The
+    # semaphore is only held while a request is in flight so polling tasks do not block others
+    request_data = {'dataset': 'wpgppop', 'year': str(year), 'geojson': payload.decode(), 'runasync': 'false'}
+    async with semaphore, session.post(WORLDPOP_STATS_URL, data=request_data) as response:
+        request_response = await _read_worldpop_response(response)
+    status, is_error = request_response['status'], request_response['error']
+
+    # If successful, return the population data
+    if 'data' in request_response and not is_error:
+        return request_response['data']
+
+    # If the task takes longer than 30s, we treat it as asynchronous and monitor
+    # the request until the data is collected
+    elif status in ['created', 'started', 'finished'] and not is_error and 'taskid' in request_response:
+
+        # Get task ID of request to monitor status
+        task_id = request_response['taskid']
+
+        attempt, deadline = 0, monotonic() + POLL_DEADLINE
+        while True:
+
+            if monotonic() > deadline:
+                raise WorldPopError('Task {0} did not finish within {1}s'.format(task_id, POLL_DEADLINE))
+
+            status_request_url = WORLDPOP_TASKS_URL + task_id
+            async with semaphore, session.get(status_request_url) as response:
+                status_response = await _read_worldpop_response(response)
+
+            # If successful, return the population data
+            if 'data' in status_response and not status_response['error']:
+                return status_response['data']
+
+            # If still no error, but the task is not finished, timeout with an exponential
+            # backoff, jittered so concurrent tasks do not poll in lockstep
+            elif status_response['status'] != 'finished' and not status_response['error']:
+                await asyncio.sleep(min(POLL_MAX_TIMEOUT, POLL_BASE_TIMEOUT * 2 ** attempt) * (0.5 + random.random()))
+                attempt = min(attempt + 1, POLL_MAX_ATTEMPT)
+
+            elif status_response['error']:
+                raise WorldPopError(status_response.get('error_message', 'Task {0} failed'.format(task_id)))
+
+            # A finished task without data or an error will never return any
+            else:
+                raise WorldPopError('Task {0} finished without returning data'.format(task_id))
+    else:
+        raise WorldPopError(request_response.get('error_description', 'Request failed'))
+
+def _get_feature_populations(data, num_features):
+    """
+    Gets the population of each feature from a WorldPop response.
+    :param data: 'data' object of the API response
+    :param num_features: Number of features sent in the request
+    :return: List of populations, or None if the response only has a collection total
+    """
+
+    if 'features' in data and len(data['features']) == num_features:
+        return [feature['total_population'] for feature in data['features']]
+    elif num_features == 1:
+        return [data['total_population']]
+    return None
+
+def _get_unpopulated_features(features, mask_file):
+    """
+    Finds features whose centroid falls in an unpopulated cell of a population mask raster.
+    :param features: GEOJSON features to check
+    :param mask_file: Raster file (eg. WorldPop binary mask) where 0 or nodata denotes unpopulated
+    :return: Boolean numpy array, True where a feature is unpopulated
+    """
+
+    import rasterio
+    from rasterio.transform import rowcol
+    from rasterio.windows import Window
+
+    # The midpoint of each ring's bounding box is the centroid of a grid cell, whether or
+    # not the ring repeats its first vertex to close it
+    rings = [np.asarray(grid['geometry']['coordinates'][0]) for grid in features]
+    centroids = np.array([(ring.min(axis=0) + ring.max(axis=0)) / 2 for ring in rings])
+
+    with rasterio.open(mask_file) as mask:
+
+        # Feature coordinates are longitude & latitude, so can only index a geographic raster
+        if mask.crs is not None and not mask.crs.is_geographic:
+            raise ValueError("Mask '{0}' must use a geographic CRS, not {1}".format(mask_file, mask.crs))
+
+        rows, cols = [np.asarray(indices) for indices in rowcol(mask.transform, centroids[:, 0], centroids[:, 1])]
+
+        # Only the window covering all centroids is read, then sampled with a single index
+        row_offset, col_offset = rows.min(), cols.min()
+        window = Window(col_offset, row_offset, cols.max() - col_offset + 1, rows.max() - row_offset + 1)
+        mask_data = mask.read(1, window=window, boundless=True, fill_value=1)
+        values = mask_data[rows - row_offset, cols - col_offset]
+
+        unpopulated = values == 0
+        if mask.nodata is not None:
+            unpopulated |= np.isnan(values) if np.isnan(mask.nodata) else values == mask.nodata
+
+    return unpopulated
+
+def _get_cache_key(grid, year):
+    """
+    Gets the population cache key of a feature, from its geometry and the year.
+    :param grid: GEOJSON feature
+    :param year: Year for population statistics (2000-2020)
+    :return: Cache key string
+    """
+
+    geometry_hash = hashlib.sha1(orjson.dumps(grid['geometry'], option=orjson.OPT_SORT_KEYS)).hexdigest()
+    return geometry_hash + ':' + str(year)
+
+def _report_fetch_error(error):
+    """
+    Prints an error from fetching populations without interrupting the progress bar.
+    :param error: Exception raised while fetching
+    """
+
+    tqdm_asyncio.write('\nError:\n - '+(str(error) or type(error).__name__))
+
+def _get_single_population(response):
+    """
+    Gets the population from the response to a single feature request, as returned by asyncio.gather.
+    :param response: 'data' object of the API response, or the exception raised by the request
+    :return: Population of the feature, or None if the request failed
+    """
+
+    try:
+        if isinstance(response, BaseException): raise response
+        return _get_feature_populations(response, 1)[0]
+    except FETCH_ERRORS as error:
+        _report_fetch_error(error)
+        return None
+
+async def _fetch_batch_population(session, semaphore, cache, pbar, batch, encoded_batch, year):
+    """
+    Fetches the WorldPop population for a batch of features and stores it in their properties.
+    :param session: aiohttp ClientSession shared between requests
+    :param semaphore: Semaphore bounding the number of concurrent requests
+    :param cache: sqlite3 connection to the population cache
+    :param pbar: Progress bar of fetched regions, updated as each feature finishes
+    :param batch: GEOJSON features to fetch population for
+    :param encoded_batch: JSON encoded features of batch
+    :param year: Year for population statistics (2000-2020)
+    :return: Tuple of (list of populations in the same order as batch, None where a feature failed or
+             None if the batch failed, whether the API returned a population for each feature, or None if unknown)
+    """
+
+    async def request_single(encoded_grid):
+        try: return await _request_worldpop_stats(session, semaphore, [encoded_grid], year)
+        finally: pbar.update(1)
+
+    # A failed batch is reported and left without populations, so the remaining
+    # batches still complete and the failed one can be resumed later
+    is_batched = None
+    try:
+        data = await _request_worldpop_stats(session, semaphore, encoded_batch, year)
+        populations = _get_feature_populations(data, len(batch))
+        is_batched = populations is not None
+
+        # If only the total for the whole collection is returned, request each feature separately,
+        # keeping the populations of any that succeed when others fail
+        if not is_batched:
+            responses = await asyncio.gather(*[request_single(encoded_grid) for encoded_grid in encoded_batch], return_exceptions=True)
+            populations = [_get_single_population(response) for response in responses]
+        else: pbar.update(len(batch))
+
+    except FETCH_ERRORS as error:
+        _report_fetch_error(error)
+        pbar.update(len(batch))
+        return None, is_batched
+
+    fetched = [(grid, grid_population) for grid, grid_population in zip(batch, populations) if grid_population is not None]
+    for grid, grid_population in fetched:
+        grid['properties']['population'] = grid_population
+
+    # Committed by _fetch_worldpop_features, to limit the number of writes to disk
+    cache.executemany('INSERT OR REPLACE INTO pop VALUES (?, ?)', [(_get_cache_key(grid, year), grid_population) for grid, grid_population in fetched])
+
+    return populations, is_batched
+
+async def _fetch_worldpop_features(features, encoded_features, cache, year, max_concurrent, batch_size):
+    """
+    Concurrently fetches the WorldPop population for a list of features in batches.
+    :param features: GEOJSON features to fetch population for
+    :param encoded_features: JSON encoded features, in the same order as features
+    :param cache: sqlite3 connection to the population cache
+    :param year: Year for population statistics (2000-2020)
+    :param max_concurrent: Maximum number of concurrent requests to the API
+    :param batch_size: Number of features sent in each request
+    """
+
+    if len(features) == 0: return
+
+    # Cache inserts are committed every CACHE_COMMIT_SIZE populations, and once all batches finish
+    num_uncommitted = 0
+    async def fetch_batch(start, size):
+        nonlocal num_uncommitted
+        populations, is_batched = await _fetch_batch_population(session, semaphore, cache, pbar, features[start:start + size], encoded_features[start:start + size], year)
+
+        num_uncommitted += len([grid_population for grid_population in populations or [] if grid_population is not None])
+        if num_uncommitted >= CACHE_COMMIT_SIZE:
+            cache.commit()
+            num_uncommitted = 0
+        return is_batched
+
+    semaphore = asyncio.Semaphore(max_concurrent)
+    connector = aiohttp.TCPConnector(limit=max_concurrent, keepalive_timeout=30)
+    with tqdm_asyncio(total=len(features), unit='region') as pbar:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            try:
+                # The first batch is sent on its own to find whether the API returns a population for each
+                # feature. If it only returns a collection total, the remaining features are sent individually
+                num_probed = min(batch_size, len(features))
+                is_batched = await fetch_batch(0, num_probed)
+                if is_batched is False: batch_size = 1
+
+                batch_starts = range(num_probed, len(features), batch_size)
+                await asyncio.gather(*[fetch_batch(i, batch_size) for i in batch_starts])
+            finally:
+                cache.commit()
+
+def get_worldpop_data(geojson_file, year=2010, output_file='pop.geojson', delete_original=True, max_concurrent=16, batch_size=50, cache_file=None, mask_file=None, pretty=False):
     """
     Fetches the WorldPop population data for each feature in a GEOJSON file.
     :param geojson_file: GEOJSON file to add data for
     :param year: Year for population statistics (2000-2020), default 2010
     :param output_file: Name of final GEOJSON output file with population data
     :param delete_original: Denotes whether to delete original geojson_file
+    :param max_concurrent: Maximum number of concurrent requests to the API, default 16
+    :param batch_size: Number of features sent in each request, default 50
+    :param cache_file: sqlite3 population cache file, default 'wpcache.db' alongside output_file
+    :param mask_file: Population mask raster, features in unpopulated cells are given 0 population without a request
+    :param pretty: Denotes whether to indent the output GEOJSON file
+    :raises WorldPopError: If any regions could not be fetched, after saving a checkpoint to resume from
     """
     
-    with open(geojson_file, 'r') as f:
-        geojson_data = json.load(f)
+    with open(geojson_file, 'rb') as f:
+        geojson_bytes = f.read()
+
+    # Resume from the checkpoint of a previous failed run if there is one, as long as
+    # it was made from the same GEOJSON file and for the same year
+    checkpoint_file = output_file + '.partial'
+    checkpoint = {'year': year, 'source': hashlib.sha1(geojson_bytes).hexdigest()}
+
+    geojson_data = None
+    if path.exists(checkpoint_file):
+        with open(checkpoint_file, 'rb') as f:
+            checkpoint_data = orjson.loads(f.read())
+        if checkpoint_data.pop('checkpoint', None) == checkpoint: geojson_data = checkpoint_data
+        else: print("Ignoring checkpoint '{0}', made from a different grid or year\n".format(checkpoint_file))
+
+    if geojson_data is None: geojson_data = orjson.loads(geojson_bytes)
 
     print('Fetching population:\n  ↳ {0} regions\n'.format(len(geojson_data['features'])))
-    
-    total_population = 0
-    pbar = tqdm(geojson_data['features'])
-    for grid in pbar:
-
-        if 'population' in grid['properties'].keys():
-            total_population += grid['properties']['population']
-            continue
-        
-        str_feature = json.dumps(grid)
-        str_feature = '{"type":"FeatureCollection","features":['+str_feature+']}'
-        
-        # Request population data for each grid in the GEOJSON file (done synchronously)
-        pbar.set_description("Sending initial request")
-        pop_request_url = "https://api.worldpop.org/v1/services/stats?dataset=wpgppop&year={0}&geojson={1}&runasync=false".format(year, str_feature)
-        request_response = requests.get(pop_request_url).json()
-        status, is_error = request_response['status'], request_response['error']
-
-        # If successful, add the population to the GEOJSON file
-        if 'data' in request_response.keys() and not is_error:
-            grid_population = request_response['data']['total_population']
-
-        # If the task takes longer than 30s, we treat it as asynchronous and monitor
-        # the request until the data is collected
-        elif status in ['created', 'started', 'finished'] and not is_error:
-            pbar.set_description("Fetching data from task id")
-            
-            # Get task ID of request to monitor status
-            task_id = request_response['taskid']
-
-            fetched, current_timeout = False, 10
-            while not fetched:
-                
-                status_request_url = 'https://api.worldpop.org/v1/tasks/' + task_id
-                status_response = requests.get(status_request_url).json()
-
-                # If successful, add the population to the GEOJSON file
-                if 'data' in status_response.keys() and not status_response['error']:
-                    fetched, grid_population = True, status_response['data']['total_population']
-
-                # If still no error, but the task is not finished, timeout and increase timeout
-                # for next iteration
-                elif status_response['status'] != 'finished' and not status_response['error']:
-                    pbar.set_description("Unsuccessful, waiting {0}".format(current_timeout))
-                    sleep(current_timeout)
-                    current_timeout += 10
-                
-                elif status_response['error']:
-                    print('\nError:\n - '+status_response['error_message'])
-                    exit()
-        else:
-            print('\nError:\n - '+request_response['error_description'])
-            with open(output_file, 'w') as output:
-                json.dump(geojson_data, output, indent=4)
-            exit()
 
-        grid['properties']['population'] = grid_population
-        total_population += grid_population
+    # Populations are cached by geometry & year, so only features that have not
+    # been fetched before are requested
+    if cache_file is None: cache_file = path.join(path.split(output_file)[0], 'wpcache.db')
+    cache = sqlite3.connect(cache_file)
+    try:
+        cache.execute('CREATE TABLE IF NOT EXISTS pop(key TEXT PRIMARY KEY, pop REAL)')
+
+        features = []
+        for grid in geojson_data['features']:
+            if 'population' in grid['properties']: continue
+
+            cached_population = cache.execute('SELECT pop FROM pop WHERE key=?', (_get_cache_key(grid, year),)).fetchone()
+            if cached_population is None: features.append(grid)
+            else: grid['properties']['population'] = cached_population[0]
+
+        # Features whose centroid is unpopulated in the mask are given 0 population without a request
+        if mask_file is not None and len(features) > 0:
+            unpopulated = _get_unpopulated_features(features, mask_file)
+            populated_features = []
+            for grid, is_unpopulated in zip(features, unpopulated):
+                if is_unpopulated: grid['properties']['population'] = 0
+                else: populated_features.append(grid)
+            features = populated_features
+            print('Skipped {0} unpopulated regions\n'.format(int(unpopulated.sum())))
+
+        # Each feature is only encoded once, and batches are joined from the encoded bytes
+        encoded_features = [orjson.dumps(grid) for grid in features]
+
+        asyncio.run(_fetch_worldpop_features(features, encoded_features, cache, year, max_concurrent, batch_size))
+    finally:
+        cache.close()
+
+    dump_option = orjson.OPT_INDENT_2 if pretty else None
+
+    # If any batches failed, the populations fetched so far are saved as a checkpoint, which
+    # is written to a temporary file first so an interrupted save cannot corrupt it
+    num_failed = len([grid for grid in features if 'population' not in grid['properties']])
+    if num_failed > 0:
+        print("\nFailed to fetch {0} regions\n  ↳ Saving progress to : '{1}', rerun to resume".format(num_failed, checkpoint_file))
+        with open(checkpoint_file + '.tmp', 'wb') as output:
+            output.write(orjson.dumps(dict(geojson_data, checkpoint=checkpoint)))
+        replace(checkpoint_file + '.tmp', checkpoint_file)
+        raise WorldPopError('Failed to fetch {0} regions'.format(num_failed))
+
+    total_population = sum(grid['properties']['population'] for grid in geojson_data['features'])
     
     print("Fetched population data!\n  ↳ Saving to : '{0}'".format(output_file))
-    with open(output_file, 'w') as output:
-        json.dump(geojson_data, output, indent=4)
+    with open(output_file, 'wb') as output:
+        output.write(orjson.dumps(geojson_data, option=dump_option))
 
+    if path.exists(checkpoint_file): remove(checkpoint_file)
     if delete_original: remove(geojson_file)
 
     filepath, _ = path.split(output_file)
@@ -206,17 +587,18 @@ def get_road_layout(bounds, output_file='roads.xml'):
     """
 
     if len(bounds) in [2, 4]:
-        max_x, min_x = max([coor[1] for coor in bounds]), min([coor[1] for coor in bounds])
-        max_y, min_y = max([coor[0] for coor in bounds]), min([coor[0] for coor in bounds])
+        min_y, max_y, min_x, max_x = get_bounds_limits(bounds)
 
     # Fetches all OSM ways (and their nodes) from within the bounds
     # Only gets ways with 'name' and 'highway' tags, ignores ways classed as areas (eg. some plazas etc)
     overpass_query = "[out:xml];way({0},{1},{2},{3})['name']['highway']['area'!~'yes'];(._;>;);out;".format(min_y, min_x, max_y, max_x)
     
     overpass_url = "http://overpass-api.de/api/interpreter"
-    response = requests.get(overpass_url, params={'data': overpass_query})
-    with open(output_file, 'w') as output:
-        output.write(response.text)
+    
+    # The response is streamed straight to disk rather than decoded into memory
+    with _SESSION.get(overpass_url, params={'data': overpass_query}, timeout=300, stream=True) as response, open(output_file, 'wb') as output:
+        response.raw.decode_content = True
+        shutil.copyfileobj(response.raw, output, length=1 << 16)
     
 if __name__ == "__main__":
 
@@ -230,7 +612,10 @@ if __name__ == "__main__":
     grid_bounds = [[50.737069, -3.559872], [50.704257, -3.491951]]
 
     generate_geojson_grid(bounds=grid_bounds, min_division=100, output_file=grid_geojson_file)
-    get_worldpop_data(grid_geojson_file, output_file=pop_geojson_file, delete_original=False)
+    try: get_worldpop_data(grid_geojson_file, output_file=pop_geojson_file, delete_original=False)
+    except WorldPopError as error:
+        print('\nError:\n - '+str(error))
+        exit()
     get_road_layout(grid_bounds, roads_xml_file)
 
     visualise_gpd_data(pop_geojson_file)
\ No newline at end of file